@@ -1,16 +1,29 @@
 from datetime import datetime, timezone
+import asyncio
+import base64
+import hashlib
+import hmac
 import os
 import logging
-import threading
-import asyncio
-from flask import Flask
+import signal
+import time
+import warnings
+from aiohttp import web
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
 from telegram.error import Forbidden  
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from pymongo import MongoClient
+from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
+from telegram.warnings import PTBUserWarning
+from telegram.ext import Application, CommandHandler, ConversationHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from motor.motor_asyncio import AsyncIOMotorClient
+import pymongo
+from pymongo.errors import OperationFailure, PyMongoError
 from dotenv import load_dotenv
-from bson import ObjectId
-from dateutil import parser  
+from bson import CodecOptions, ObjectId
+from bson.raw_bson import RawBSONDocument
+import orjson
+from cachetools import TTLCache
 
 load_dotenv()
 
@@ -18,30 +31,281 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 MONGO_DB = os.getenv("MONGO_DB")
 MONGO_CHECK_URI = os.getenv("MONGO_CHECK_URI") 
+PORT = int(os.environ.get("PORT", 5000))
+# Public base URL of this app; when set, Telegram pushes updates to us instead of being polled
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+# Only the update types there are handlers for; Telegram remembers this list between calls
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+# One-off backfill of string dates in the chatbot's users collection; that database isn't ours, so opt-in only
+MIGRATE_CHECK_DATES = os.getenv("MIGRATE_CHECK_DATES") == "1"
+# Seconds per field; replaces the client's socketTimeoutMS and is sent to the server as maxTimeMS
+MIGRATE_CHECK_DATES_TIMEOUT = 600
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
-mongo_client = MongoClient(MONGO_DB)
+# Keep a few sockets warm and fail fast instead of queueing behind an unreachable server
+MONGO_CLIENT_OPTIONS = dict(
+    maxPoolSize=20,
+    minPoolSize=5,
+    maxIdleTimeMS=60000,
+    retryWrites=True,
+    waitQueueTimeoutMS=2000,
+    serverSelectionTimeoutMS=3000,
+    connectTimeoutMS=3000,
+    socketTimeoutMS=10000,
+    compressors="zlib"
+)
+
+def create_mongo_client(uri: str) -> AsyncIOMotorClient:
+    options = dict(MONGO_CLIENT_OPTIONS)
+    if uri.startswith("mongodb+srv://"):
+        # SRV URIs always use TLS; verify against certifi's bundle rather than whatever the host ships
+        import certifi
+        options["tlsCAFile"] = certifi.where()
+    return AsyncIOMotorClient(uri, **options)
+
+mongo_client = create_mongo_client(MONGO_DB)
 db = mongo_client.get_default_database("support")
 tickets_collection = db.tickets
+# For lookups that read a field or two: skips materialising the BSON into a dict
+raw_tickets_collection = tickets_collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
 
-mongo_check_client = MongoClient(MONGO_CHECK_URI)
+mongo_check_client = create_mongo_client(MONGO_CHECK_URI)
 check_db = mongo_check_client.GeorgiaChatbot  
 
-app = Flask(__name__)
-bot_app = Application.builder().token(BOT_TOKEN).build()
+# user_id -> bool, so the per-message blocked check skips MongoDB for known users
+BLOCK_CACHE = TTLCache(maxsize=10000, ttl=60)
+
+# Per-user token bucket: bursts of FLOOD_BURST messages, refilled at FLOOD_RATE per second.
+# Messages over the limit put the bucket into debt (down to -FLOOD_BURST) so a steady flood stays throttled.
+FLOOD_RATE = 0.5
+FLOOD_BURST = 10
+FLOOD_BUCKETS = TTLCache(maxsize=10000, ttl=300)
+
+# callback_data is "<tag>|<arg>"; ticket ids travel as the raw 12 ObjectId bytes in base64url
+CB_READ = "r"
+CB_REPLY = "y"
+CB_BLOCK = "b"
+CB_CHECK = "c"
+CB_UNBAN = "u"
+
+# Tags on notifications sent before the compact format; their ticket ids are 24 hex characters
+LEGACY_CB_READ = "read_ticket"
+LEGACY_CB_REPLY = "reply_ticket"
+LEGACY_CB_BLOCK = "block_user"
+LEGACY_CB_CHECK = "check_user"
+LEGACY_CB_UNBAN = "unban_user"
+
+# Conversation state while the admin's next message is the reply to a ticket
+AWAIT_REPLY = 0
+
+# MarkdownV2 admin notification split around the user-controlled fields
+ADMIN_MESSAGE_TEMPLATE = (
+    "📩 *New Message from User*\n👤 *User:* ",
+    " \\(@",
+    "\\)\n🆔 *UID:* `",
+    "`\n\n💬 *Message:*\n",
+    "\n\n📝 *Ticket ID:* `",
+    "`"
+)
+
+MARK_READ_LABEL = "Mark as Read"
+REPLY_LABEL = "Reply"
+BLOCK_LABEL = "Block User"
+CHECK_LABEL = "Check User"
+UNBAN_LABEL = "Unban User"
+
+def build_ticket_keyboard(ticket_cd: str, user_id: int, chat_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup((
+        (InlineKeyboardButton(MARK_READ_LABEL, callback_data=f"{CB_READ}|{ticket_cd}|{chat_id}"),),
+        (InlineKeyboardButton(REPLY_LABEL, callback_data=f"{CB_REPLY}|{ticket_cd}"),),
+        (
+            InlineKeyboardButton(BLOCK_LABEL, callback_data=f"{CB_BLOCK}|{user_id}"),
+            InlineKeyboardButton(CHECK_LABEL, callback_data=f"{CB_CHECK}|{user_id}")
+        )
+    ))
+
+def encode_oid(oid: ObjectId) -> str:
+    return base64.urlsafe_b64encode(oid.binary).decode()
+
+def decode_oid(data: str) -> ObjectId:
+    # base64url of the 12 bytes is 16 characters, so hex ids from legacy buttons can't be mistaken for it
+    if len(data) == 24:
+        return ObjectId(data)
+    return ObjectId(base64.urlsafe_b64decode(data))
+
+def callback_pattern(*tags: str) -> str:
+    return f"^(?:{'|'.join(tags)})\\|"
+
+# ticket ObjectId -> user_chat_id; a ticket's chat never changes, so replies can skip the lookup
+TICKET_CACHE = TTLCache(maxsize=10000, ttl=24 * 60 * 60)
+
+# user_id -> (report text, is_banned) for the Check User button
+CHECK_CACHE = TTLCache(maxsize=1000, ttl=30)
+
+CHECK_USER_PROJECTION = {
+    "username": 1, "gender": 1, "premium": 1, "premium_until": 1, "ban_until": 1,
+    "blocked_bot": 1, "last_active": 1, "ban_history": 1, "auto_delete": 1
+}
+
+async def ensure_indexes():
+    existing = await db.blocked_users.index_information()
+    # A non-unique user_id_1 means duplicates already blocked the unique build; retrying would only conflict with it
+    if "user_id_1" not in existing:
+        try:
+            await db.blocked_users.create_index("user_id", unique=True)
+        except OperationFailure as e:
+            # Older deployments may already hold duplicate entries; still avoid the collection scan.
+            logger.error("Could not create unique index on blocked_users.user_id: %s", e)
+            await db.blocked_users.create_index("user_id")
+    await tickets_collection.create_index([("status", 1), ("_id", -1)])
+
+async def migrate_check_dates():
+    # The chatbot sometimes stored these as ISO strings; convert them to BSON dates in place
+    for field in ("premium_until", "ban_until"):
+        try:
+            # The server stops at the same deadline, so a timeout really means the scan was cut short;
+            # converted documents no longer match the filter and a rerun picks up the rest
+            with pymongo.timeout(MIGRATE_CHECK_DATES_TIMEOUT):
+                result = await check_db.users.update_many(
+                    {field: {"$type": "string"}},
+                    [{"$set": {field: {"$convert": {"input": f"${field}", "to": "date", "onError": f"${field}"}}}}]
+                )
+        except PyMongoError as e:
+            logger.error("Could not convert users.%s to dates: %s", field, e)
+        else:
+            logger.info("Converted users.%s on %s documents", field, result.modified_count)
+
+async def get_ticket_chat_id(oid: ObjectId):
+    user_chat_id = TICKET_CACHE.get(oid)
+    if user_chat_id is None:
+        ticket = await raw_tickets_collection.find_one({"_id": oid}, {"user_chat_id": 1})
+        if not ticket:
+            return None
+        user_chat_id = TICKET_CACHE[oid] = ticket["user_chat_id"]
+    return user_chat_id
+
+def consume_flood_token(user_id: int) -> float:
+    now = time.monotonic()
+    tokens, last = FLOOD_BUCKETS.get(user_id, (FLOOD_BURST, now))
+    tokens = max(-FLOOD_BURST, min(FLOOD_BURST, tokens + (now - last) * FLOOD_RATE) - 1)
+    FLOOD_BUCKETS[user_id] = (tokens, now)
+    return tokens
+
+async def block_user(user_id: int):
+    await db.blocked_users.update_one(
+        {"user_id": user_id},
+        {"$setOnInsert": {"blocked_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    BLOCK_CACHE[user_id] = True
+
+async def index(request: web.Request):
+    return web.Response(text='hello')
+
+async def telegram_webhook(request: web.Request):
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode()
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET.encode()):
+        return web.Response(status=403)
+    await bot_app.update_queue.put(Update.de_json(orjson.loads(await request.read()), bot_app.bot))
+    return web.Response()
+
+web_app = web.Application()
+web_app.router.add_get('/', index)
+if WEBHOOK_URL:
+    # In polling mode nothing should be able to inject updates over HTTP
+    web_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+web_runner = web.AppRunner(web_app)
+
+async def post_init(application: Application):
+    # Health endpoint shares the bot's event loop instead of a separate server thread
+    await web_runner.setup()
+    await web.TCPSite(web_runner, '0.0.0.0', PORT).start()
+    try:
+        await ensure_indexes()
+    except PyMongoError as e:
+        # The indexes only speed things up; an unreachable cluster at boot must not keep the bot down
+        logger.error("Could not ensure MongoDB indexes: %s", e)
+    if MIGRATE_CHECK_DATES:
+        # Scans the whole users collection, so it runs alongside the bot rather than holding up startup
+        application.bot_data["check_dates_migration"] = asyncio.create_task(migrate_check_dates())
+
+async def post_shutdown(application: Application):
+    migration = application.bot_data.pop("check_dates_migration", None)
+    if migration is not None:
+        migration.cancel()
+    await web_runner.cleanup()
+
+class OrjsonHTTPXRequest(HTTPXRequest):
+    @staticmethod
+    def parse_json_payload(payload: bytes):
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # PTB's own parser tolerates invalid UTF-8 and raises the error PTB expects
+            return HTTPXRequest.parse_json_payload(payload)
+
+bot_app = (
+    Application.builder()
+    .token(BOT_TOKEN)
+    .request(OrjsonHTTPXRequest(connection_pool_size=64, http_version="2", read_timeout=30, connect_timeout=10))
+    # getUpdates gets its own client so a pending long poll never holds up outgoing sends
+    .get_updates_request(OrjsonHTTPXRequest(connection_pool_size=1, http_version="2", connect_timeout=10))
+    .post_init(post_init)
+    .post_shutdown(post_shutdown)
+    .build()
+)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.from_user.id == ADMIN_ID:
-        if 'reply_ticket_id' in context.user_data:
-            del context.user_data['reply_ticket_id']
     await update.message.reply_text("მოგესალმებით! რით შეგვიძლია დაგეხმაროთ? გთხოვთ მოიწერეთ სრული ტექსტი!\n\nგაითვალისწინეთ ეს ბოტი არის დახმარების ცენტრი, თუ გსურთ ჩვენი ანონიმური ჩათბოტი, გადადით აქ -> @GeorgiaChatBot")
 
+async def notify_admin(context: ContextTypes.DEFAULT_TYPE, media_type, file_id, admin_message: str, reply_markup: InlineKeyboardMarkup):
+    if media_type == 'photo':
+        await context.bot.send_photo(
+            chat_id=ADMIN_ID,
+            photo=file_id,
+            caption=admin_message,
+            reply_markup=reply_markup,
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+    elif media_type == 'voice':
+        await context.bot.send_voice(
+            chat_id=ADMIN_ID,
+            voice=file_id,
+            caption=admin_message,
+            reply_markup=reply_markup,
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+    elif media_type == 'video':
+        await context.bot.send_video(
+            chat_id=ADMIN_ID,
+            video=file_id,
+            caption=admin_message,
+            reply_markup=reply_markup,
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+    else:
+        await context.bot.send_message(
+            chat_id=ADMIN_ID,
+            text=admin_message,
+            reply_markup=reply_markup,
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+
 async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
+    tokens = consume_flood_token(user.id)
+    if tokens < 0:
+        # Only the first message over the limit gets a notice, so a flood isn't answered message for message
+        if tokens >= -1:
+            await update.message.reply_text("ძალიან ბევრ შეტყობინებას აგზავნით, გთხოვთ სცადოთ ცოტა ხანში.")
+        return
+
     chat_id = update.message.chat_id
     text = ""
     media_type = None
@@ -62,22 +326,27 @@ async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     else:
         text = update.message.text
 
-    blocked = await asyncio.to_thread(
-        lambda: db.blocked_users.find_one({"user_id": user.id})
-    )
+    blocked = BLOCK_CACHE.get(user.id)
+    if blocked is None:
+        doc = await db.blocked_users.find_one({"user_id": user.id}, projection={"_id": 1})
+        blocked = doc is not None
+        BLOCK_CACHE[user.id] = blocked
     if blocked:
         await update.message.reply_text("თქვენ დაბლოკილი ხართ და აღარ შეგიძლიათ შეტყობინებების გაგზავნა")
         return
 
-    if user.id == ADMIN_ID:
-        if 'reply_ticket_id' in context.user_data:
-            return
-        await update.message.reply_text("Use the Reply button to respond to tickets.")
-        return
+    # The acknowledgement doesn't depend on the ticket, so let it overlap the insert and admin notification
+    context.application.create_task(
+        update.message.reply_text("შეტყობინება გაგზავნილია ადმინისტრაციაში, გთოჩნ დაელოდო პასუხს!"),
+        update=update
+    )
 
-    username = user.username if user.username else f"{user.first_name or ''} {user.last_name or ''}".strip()
+    username = user.username or " ".join(p for p in (user.first_name, user.last_name) if p) or str(user.id)
 
+    # The id is generated here so the admin notification doesn't wait for the insert round trip
+    oid = ObjectId()
     ticket = {
+        "_id": oid,
         "user_id": user.id,
         "user_chat_id": chat_id,
         "username": username,
@@ -85,209 +354,190 @@ async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         "status": "new",
         "media": {"type": media_type, "file_id": file_id} if media_type else None
     }
-    ticket_id = await asyncio.to_thread(
-        lambda: str(tickets_collection.insert_one(ticket).inserted_id)
-    )
-
-    keyboard = [
-        [InlineKeyboardButton("Mark as Read", callback_data=f"read_ticket|{ticket_id}")],
-        [InlineKeyboardButton("Reply", callback_data=f"reply_ticket|{ticket_id}")],
-        [
-            InlineKeyboardButton("Block User", callback_data=f"block_user|{user.id}"),
-            InlineKeyboardButton("Check User", callback_data=f"check_user|{user.id}")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    admin_message = (
-        f"📩 *New Message from User*\n"
-        f"👤 *User:* {user.first_name} (@{username})\n"
-        f"🆔 *UID:* `{user.id}`\n\n"
-        f"💬 *Message:*\n{text}\n\n"
-        f"📝 *Ticket ID:* `{ticket_id}`"
-    )
+    context.application.create_task(tickets_collection.insert_one(ticket), update=update)
+    ticket_id = str(oid)
+    TICKET_CACHE[oid] = chat_id
+    reply_markup = build_ticket_keyboard(encode_oid(oid), user.id, chat_id)
+
+    admin_message = "".join((
+        ADMIN_MESSAGE_TEMPLATE[0], escape_markdown(user.first_name or "", version=2),
+        ADMIN_MESSAGE_TEMPLATE[1], escape_markdown(username, version=2),
+        ADMIN_MESSAGE_TEMPLATE[2], str(user.id),
+        ADMIN_MESSAGE_TEMPLATE[3], escape_markdown(text, version=2),
+        ADMIN_MESSAGE_TEMPLATE[4], ticket_id,
+        ADMIN_MESSAGE_TEMPLATE[5]
+    ))
 
     try:
-        if media_type == 'photo':
-            await context.bot.send_photo(
-                chat_id=ADMIN_ID,
-                photo=file_id,
-                caption=admin_message,
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
-        elif media_type == 'voice':
-            await context.bot.send_voice(
-                chat_id=ADMIN_ID,
-                voice=file_id,
-                caption=admin_message,
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
-        elif media_type == 'video':
-            await context.bot.send_video(
-                chat_id=ADMIN_ID,
-                video=file_id,
-                caption=admin_message,
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
-        else:
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=admin_message,
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
-            )
-        logger.info(f"✅ Sent message to admin ({ADMIN_ID}) from {user.id}.")
+        await notify_admin(context, media_type, file_id, admin_message, reply_markup)
+        logger.info("✅ Sent message to admin (%s) from %s.", ADMIN_ID, user.id)
     except Exception as e:
-        logger.error(f"❌ Failed to send message to admin ({ADMIN_ID}): {e}")
+        logger.error("❌ Failed to send message to admin (%s): %s", ADMIN_ID, e)
 
-    await update.message.reply_text("შეტყობინება გაგზავნილია ადმინისტრაციაში, გთოჩნ დაელოდო პასუხს!")
+async def handle_read_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    _, _, arg = query.data.partition("|")
+    ticket_cd, _, chat_id = arg.partition("|")
+    oid = decode_oid(ticket_cd)
+    # Newer buttons carry the user's chat id, so the status write needn't hold up the replies
+    user_chat_id = int(chat_id) if chat_id else await get_ticket_chat_id(oid)
+    context.application.create_task(
+        tickets_collection.update_one({"_id": oid}, {"$set": {"status": "read"}}),
+        update=update
+    )
+    sends = [query.edit_message_text(text="ბილეთი დახურულია!")]
+    if user_chat_id is not None:
+        sends.append(context.bot.send_message(
+            chat_id=user_chat_id,
+            text="თქვენი მოთხოვნა განიხილა და საკითხი დახურულია!"
+        ))
+    edit_result, *notify_result = await asyncio.gather(*sends, return_exceptions=True)
+    if isinstance(edit_result, Exception):
+        logger.error("Failed to mark ticket %s as read in the admin chat: %s", oid, edit_result)
+    if notify_result and isinstance(notify_result[0], Exception):
+        if isinstance(notify_result[0], Forbidden):
+            logger.error("User %s blocked the bot: %s", user_chat_id, notify_result[0])
+            await block_user(user_chat_id)
+        else:
+            logger.error("Error notifying user %s about closed ticket %s: %s", user_chat_id, oid, notify_result[0])
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_reply_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    _, _, arg = query.data.partition("|")
+    context.user_data['reply_ticket_id'] = decode_oid(arg)
+    await query.message.reply_text("შეიყვანე შეტყობინება: ")
+    return AWAIT_REPLY
 
-    data = query.data
-    if data.startswith("read_ticket"):
-        _, ticket_id = data.split("|")
-        await asyncio.to_thread(
-            lambda: tickets_collection.update_one(
-                {"_id": ObjectId(ticket_id)},
-                {"$set": {"status": "read"}}
-            )
-        )
-        ticket = await asyncio.to_thread(
-            lambda: tickets_collection.find_one({"_id": ObjectId(ticket_id)})
-        )
-        if ticket:
-            user_chat_id = ticket["user_chat_id"]
-            await context.bot.send_message(
-                chat_id=user_chat_id,
-                text="თქვენი მოთხოვნა განიხილა და საკითხი დახურულია!"
-            )
-        await query.edit_message_text(text="ბილეთი დახურულია!")
-    elif data.startswith("reply_ticket"):
-        _, ticket_id = data.split("|")
-        context.user_data['reply_ticket_id'] = ticket_id
-        await query.message.reply_text("შეიყვანე შეტყობინება: ")
-
-    elif data.startswith("unban_user"):
-        _, user_id = data.split("|")
-        user_id = int(user_id)
-        
-        result = await asyncio.to_thread(
-            lambda: check_db.users.update_one(
-                {"_id": user_id},
-                {
-                    "$set": {"ban_until": None},
-                    "$unset": {"ban_reason": ""}
-                }
-            )
-        )
-        
-        if result.modified_count > 0:
-            original_text = query.message.text
-            new_text = original_text.replace("🚫 Banned: Yes", "🚫 Banned: No")
-            new_text += "\n\n✅ User has been unbanned."
-            await query.edit_message_text(
-                text=new_text,
-                parse_mode="Markdown"
-            )
-        else:
-            await query.answer("❌ No changes made - user might not exist or wasn't banned")
-
-    elif data.startswith("block_user"):
-        _, user_id = data.split("|")
-        user_id = int(user_id)
-        blocked_user = {
-            "user_id": user_id,
-            "blocked_at": datetime.now(timezone.utc)
+async def handle_unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    _, _, arg = query.data.partition("|")
+    user_id = int(arg)
+
+    result = await check_db.users.update_one(
+        {"_id": user_id},
+        {
+            "$set": {"ban_until": None},
+            "$unset": {"ban_reason": ""}
         }
-        await asyncio.to_thread(
-            lambda: db.blocked_users.insert_one(blocked_user)
-        )
-        await query.edit_message_text(text=f"User {user_id} has been blocked.")
-
-    elif data.startswith("check_user"):
-        _, user_id = data.split("|")
-        user_id = int(user_id)
-        
-        user = await asyncio.to_thread(
-            lambda: check_db.users.find_one({"_id": user_id})
+    )
+
+    CHECK_CACHE.pop(user_id, None)
+
+    if result.modified_count > 0:
+        original_text = query.message.text
+        new_text = original_text.replace("🚫 Banned: Yes", "🚫 Banned: No")
+        new_text += "\n\n✅ User has been unbanned."
+        await query.answer()
+        await query.edit_message_text(
+            text=new_text,
+            parse_mode="Markdown"
         )
-        
-        if not user:
+    else:
+        await query.answer("❌ No changes made - user might not exist or wasn't banned")
+
+async def handle_block_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    _, _, arg = query.data.partition("|")
+    user_id = int(arg)
+    await block_user(user_id)
+    await query.edit_message_text(text=f"User {user_id} has been blocked.")
+
+def to_utc_datetime(value):
+    if not value:
+        return None
+    if isinstance(value, str):
+        # Strings that aren't ISO-8601 survive the date migration unchanged
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            logger.warning("Ignoring unparseable date %r", value)
+            return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+async def build_user_report(user_id: int):
+    user = await check_db.users.find_one({"_id": user_id}, CHECK_USER_PROJECTION)
+    if not user:
+        return None
+
+    current_time = datetime.now(timezone.utc)
+    premium_until = to_utc_datetime(user.get("premium_until"))
+    is_premium = user.get("premium", False) and premium_until and premium_until > current_time
+
+    ban_until = to_utc_datetime(user.get("ban_until"))
+    is_banned = bool(ban_until) and ban_until > current_time
+
+    blocked_bot = user.get("blocked_bot", False)
+
+    message = (
+        f"🔍 *User Check Results*\n"
+        f"🆔 User ID: `{user_id}`\n"
+        f"👤 Username: @{user.get('username', 'N/A')}\n"
+        f"⚧ Gender: {user.get('gender', 'Not set')}\n"
+        f"💎 Premium: {'Yes ✅' if is_premium else 'No ❌'}\n"
+        f"🚫 Banned: {'Yes ❎' if is_banned else 'No ❌'}\n"
+        f"🤖 Blocked Bot: {'Yes ❎' if blocked_bot else 'No ❌'}\n"
+        f"📅 Last Active: {user.get('last_active', 'N/A')}\n"
+        f"🔨 Ban Count: {len(user.get('ban_history', []))}\n"
+        f"📝 Auto Delete: {'Enabled' if user.get('auto_delete', True) else 'Disabled'}"
+    )
+    return message, is_banned
+
+async def handle_check_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    _, _, arg = query.data.partition("|")
+    user_id = int(arg)
+
+    report = CHECK_CACHE.get(user_id)
+    if report is None:
+        report = await build_user_report(user_id)
+        if report is None:
             await query.message.reply_text(f"User {user_id} not found in check database.")
             return
+        CHECK_CACHE[user_id] = report
+    message, is_banned = report
 
-        current_time = datetime.now(timezone.utc)
-        premium_until = user.get("premium_until")
-        if isinstance(premium_until, str):
-            premium_until = parser.parse(premium_until)
-        if premium_until and premium_until.tzinfo is None:
-            premium_until = premium_until.replace(tzinfo=timezone.utc)
-        is_premium = user.get("premium", False) and premium_until and premium_until > current_time
-        
-        ban_until = user.get("ban_until")
-        is_banned = False
-        if ban_until:
-            if isinstance(ban_until, str):
-                ban_until = parser.parse(ban_until)
-            if ban_until.tzinfo is None:
-                ban_until = ban_until.replace(tzinfo=timezone.utc)
-            is_banned = ban_until > current_time
-        
-        blocked_bot = user.get("blocked_bot", False)
-        
-        message = (
-            f"🔍 *User Check Results*\n"
-            f"🆔 User ID: `{user_id}`\n"
-            f"👤 Username: @{user.get('username', 'N/A')}\n"
-            f"⚧ Gender: {user.get('gender', 'Not set')}\n"
-            f"💎 Premium: {'Yes ✅' if is_premium else 'No ❌'}\n"
-            f"🚫 Banned: {'Yes ❎' if is_banned else 'No ❌'}\n"
-            f"🤖 Blocked Bot: {'Yes ❎' if blocked_bot else 'No ❌'}\n"
-            f"📅 Last Active: {user.get('last_active', 'N/A')}\n"
-            f"🔨 Ban Count: {len(user.get('ban_history', []))}\n"
-            f"📝 Auto Delete: {'Enabled' if user.get('auto_delete', True) else 'Disabled'}"
-        )
-        
-        await context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=message,
-            parse_mode="Markdown"
-        )
-        keyboard = []
-        if is_banned:
-            keyboard.append([InlineKeyboardButton("Unban User", callback_data=f"unban_user|{user_id}")])
-        reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-        
-        await context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=message,
-            parse_mode="Markdown",
-            reply_markup=reply_markup
+    reply_markup = None
+    if is_banned:
+        reply_markup = InlineKeyboardMarkup.from_button(
+            InlineKeyboardButton(UNBAN_LABEL, callback_data=f"{CB_UNBAN}|{user_id}")
         )
-async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.message.from_user
-    if user.id != ADMIN_ID:
-        return
 
-    ticket_id = context.user_data.get('reply_ticket_id')
-    if not ticket_id:
-        return
-
-    ticket = await asyncio.to_thread(
-        lambda: tickets_collection.find_one({"_id": ObjectId(ticket_id)})
+    await context.bot.send_message(
+        chat_id=ADMIN_ID,
+        text=message,
+        parse_mode="Markdown",
+        reply_markup=reply_markup
     )
-    if not ticket:
+
+async def handle_stale_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Buttons whose callback_data matches neither the current nor the legacy format
+    await update.callback_query.answer("This button is no longer supported.")
+
+async def remind_reply_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Use the Reply button to respond to tickets.")
+    return ConversationHandler.END
+
+async def cancel_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.pop('reply_ticket_id', None)
+    await update.message.reply_text("Reply cancelled.")
+    return ConversationHandler.END
+
+async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    oid = context.user_data.pop('reply_ticket_id', None)
+    if oid is None:
+        await update.message.reply_text("Use the Reply button to respond to tickets.")
+        return ConversationHandler.END
+    user_chat_id = await get_ticket_chat_id(oid)
+    if user_chat_id is None:
         await update.message.reply_text("Ticket not found.")
-        del context.user_data['reply_ticket_id']
-        return
+        return ConversationHandler.END
 
-    user_chat_id = ticket["user_chat_id"]
     sent = False  # Track if message was sent successfully
 
     try:
@@ -323,33 +573,24 @@ async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             sent = True
     except Forbidden as e:
-        logger.error(f"User {user_chat_id} blocked the bot: {e}")
+        logger.error("User %s blocked the bot: %s", user_chat_id, e)
         await update.message.reply_text("❌ შეტყობინების გაგზავნა ვერ მოხერხდა: მომხმარებელმა ბოტი დაბლოკა.")
         # Add user to blocked list
-        await asyncio.to_thread(
-            lambda: db.blocked_users.insert_one({
-                "user_id": user_chat_id,
-                "blocked_at": datetime.now(timezone.utc)
-            })
-        )
+        await block_user(user_chat_id)
     except Exception as e:
-        logger.error(f"Error sending message to user {user_chat_id}: {e}")
+        logger.error("Error sending message to user %s: %s", user_chat_id, e)
         await update.message.reply_text(f"❌ შეტყობინების გაგზავნა ვერ მოხერხდა: {e}")
     else:
         if sent:
             await update.message.reply_text("შეტყობინება გაიგზავნა მომხმარებელთან!")
-    finally:
-        if 'reply_ticket_id' in context.user_data:
-            del context.user_data['reply_ticket_id']
+    return ConversationHandler.END
 
 async def test_admin_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if 'reply_ticket_id' in context.user_data:
-        del context.user_data['reply_ticket_id']
     try:
         await context.bot.send_message(chat_id=ADMIN_ID, text="🔧 Admin test message.")
-        logger.info(f"Successfully sent test message to ADMIN_ID ({ADMIN_ID}).")
+        logger.info("Successfully sent test message to ADMIN_ID (%s).", ADMIN_ID)
     except Exception as e:
-        logger.error(f"Failed to send test message to admin: {e}")
+        logger.error("Failed to send test message to admin: %s", e)
 
 async def reply_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
@@ -357,9 +598,6 @@ async def reply_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Unauthorized command.")
         return
 
-    if 'reply_ticket_id' in context.user_data:
-        del context.user_data['reply_ticket_id']
-
     args = context.args
     if len(args) < 2:
         await update.message.reply_text("Usage: /reply <ticket_id> <message>")
@@ -368,29 +606,20 @@ async def reply_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ticket_id = args[0]
     reply_text = " ".join(args[1:])
 
-    try:
-        ticket = await asyncio.to_thread(
-            lambda: tickets_collection.find_one({"_id": ObjectId(ticket_id)})
-        )
-    except Exception:
+    if not ObjectId.is_valid(ticket_id):
         await update.message.reply_text("Invalid ticket ID.")
         return
 
-    if not ticket:
+    user_chat_id = await get_ticket_chat_id(ObjectId(ticket_id))
+    if user_chat_id is None:
         await update.message.reply_text("Ticket not found.")
         return
 
-    user_chat_id = ticket["user_chat_id"]
     try:
         await context.bot.send_message(chat_id=user_chat_id, text=f"Admin: {reply_text}")
     except Forbidden as e:
         await update.message.reply_text("❌ Cannot send reply: user has blocked the bot.")
-        await asyncio.to_thread(
-            lambda: db.blocked_users.insert_one({
-                "user_id": user_chat_id,
-                "blocked_at": datetime.now(timezone.utc)
-            })
-        )
+        await block_user(user_chat_id)
         return
     except Exception as e:
         await update.message.reply_text(f"Error sending message: {e}")
@@ -398,30 +627,73 @@ async def reply_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text("Reply sent to the user.")
 
+# Edits arrive as edited_message with update.message unset, so only new messages count
+message_filter = filters.UpdateType.MESSAGE & (filters.TEXT | filters.PHOTO | filters.VOICE | filters.VIDEO) & (~filters.COMMAND)
+admin_filter = filters.User(user_id=ADMIN_ID)
+
+reply_button_handler = CallbackQueryHandler(handle_reply_ticket, pattern=callback_pattern(CB_REPLY, LEGACY_CB_REPLY))
+
+# The reply state is tracked per admin chat, not per notification message, which is what
+# per_message=False gives; PTB warns about CallbackQueryHandlers under that setting regardless
+warnings.filterwarnings(
+    "ignore",
+    message=r"If 'per_message=False', 'CallbackQueryHandler' will not be tracked",
+    category=PTBUserWarning
+)
+
+# Runs in an earlier group so that a command sent mid-reply cancels it and is still handled normally below
+bot_app.add_handler(ConversationHandler(
+    entry_points=[reply_button_handler, MessageHandler(message_filter & admin_filter, remind_reply_button)],
+    states={
+        AWAIT_REPLY: [MessageHandler(message_filter & admin_filter, handle_admin_reply), reply_button_handler]
+    },
+    fallbacks=[MessageHandler(filters.COMMAND, cancel_reply)],
+    per_message=False
+), group=-1)
 bot_app.add_handler(CommandHandler("start", start))
-bot_app.add_handler(MessageHandler(
-    (filters.TEXT | filters.PHOTO | filters.VOICE | filters.VIDEO) & (~filters.COMMAND),
-    handle_user_message
+bot_app.add_handler(MessageHandler(message_filter & ~admin_filter, handle_user_message))
+bot_app.add_handler(CallbackQueryHandler(handle_read_ticket, pattern=callback_pattern(CB_READ, LEGACY_CB_READ)))
+bot_app.add_handler(CallbackQueryHandler(handle_block_user, pattern=callback_pattern(CB_BLOCK, LEGACY_CB_BLOCK)))
+bot_app.add_handler(CallbackQueryHandler(handle_check_user, pattern=callback_pattern(CB_CHECK, LEGACY_CB_CHECK)))
+bot_app.add_handler(CallbackQueryHandler(handle_unban_user, pattern=callback_pattern(CB_UNBAN, LEGACY_CB_UNBAN)))
+bot_app.add_handler(CallbackQueryHandler(
+    handle_stale_button,
+    pattern="^(?!" + callback_pattern(
+        CB_READ, CB_REPLY, CB_BLOCK, CB_CHECK, CB_UNBAN,
+        LEGACY_CB_READ, LEGACY_CB_REPLY, LEGACY_CB_BLOCK, LEGACY_CB_CHECK, LEGACY_CB_UNBAN
+    ) + ")"
 ))
-bot_app.add_handler(CallbackQueryHandler(button_callback))
 bot_app.add_handler(CommandHandler("reply", reply_command))
 bot_app.add_handler(CommandHandler("testadmin", test_admin_message))
-bot_app.add_handler(MessageHandler(
-    filters.Chat(chat_id=ADMIN_ID) & (filters.TEXT | filters.PHOTO | filters.VOICE | filters.VIDEO) & (~filters.COMMAND),
-    handle_admin_reply
-), group=1)
 
-@app.route('/')
-def index():
-    return 'hello'
+async def run_webhook():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with bot_app:
+        try:
+            # Same startup as polling mode, which also brings up the aiohttp server that receives the updates
+            await post_init(bot_app)
+            await bot_app.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES
+            )
+            await bot_app.start()
+            await stop.wait()
+        finally:
+            if bot_app.running:
+                await bot_app.stop()
+            await post_shutdown(bot_app)
 
 def main():
-    flask_thread = threading.Thread(
-        target=lambda: app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 5000))),
-        daemon=True
-    )
-    flask_thread.start()
-    bot_app.run_polling()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook())
+    else:
+        # PTB adds the long-poll timeout on top of the getUpdates read timeout itself
+        bot_app.run_polling(timeout=30, bootstrap_retries=-1, allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file